@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''
+airprint.py: repeat shared CUPS queues as AirPrint services
+
+airprint.py is a thin wrapper around the BonjourRepeater class from
+bonjour-repeater.py, preconfigured to rebroadcast print queues shared by
+this machine with the TXT records that AirPrint clients expect. Any
+improvement to the repeater class applies here automatically.
+'''
+
+import os.path
+from importlib import util
+
+# Used to grab the Bonjour name
+from SystemConfiguration import SCDynamicStoreCopyLocalHostName
+
+# The repeater module is not importable by name because of the hyphen in
+# its file name, so load it from the file installed alongside this script
+_spec = util.spec_from_file_location('bonjour_repeater', os.path.join(
+	os.path.dirname(os.path.abspath(__file__)), 'bonjour-repeater.py'))
+_mod = util.module_from_spec(_spec)
+_spec.loader.exec_module(_mod)
+
+BonjourRepeater = _mod.BonjourRepeater
+
+
+if __name__ == '__main__':
+	# Grab the local Bonjour name to restrict repetition
+	hostname = SCDynamicStoreCopyLocalHostName(None) + '.local.'
+
+	# Build a repeater for shared CUPS queues
+	rpt = BonjourRepeater('_ipp._tcp,_cups', '_ipp._tcp,_universal',
+			['URF=W8,CP1,RS300-600,DM3,SRGB24'],
+			['pdl=application/pdf,application/postscript,'
+				'image/jpeg,image/png,image/pwg-raster,image/urf'],
+			prefix='AirPrint', restrict=hostname)
+
+	print('Starting AirPrint repeater for target host', hostname)
+
+	# Start the listening loop
+	try: rpt.repeatloop()
+	except KeyboardInterrupt: pass
+
+	print('All repeated AirPrint services removed')
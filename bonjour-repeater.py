@@ -1,10 +1,43 @@
 #!/usr/bin/env python
 
-import sys, getopt, select, pybonjour as mdns
+import sys, getopt, time, selectors, collections, pybonjour as mdns
 
 # Used to grab the Bonjour name
 from SystemConfiguration import SCDynamicStoreCopyLocalHostName
 
+# Pick the best available readiness mechanism; DefaultSelector degrades
+# from epoll (Linux) or kqueue (macOS) to poll() before ever reaching
+# select(), so the compact pollfd interface is the worst realistic case
+_Selector = selectors.DefaultSelector
+if _Selector is selectors.SelectSelector:
+	_Selector = getattr(selectors, 'PollSelector', _Selector)
+
+
+def _txtkeys(txt):
+	'''
+	Walk a raw TXT record (a length-prefixed sequence of key[=value]
+	entries, per RFC 6763) in a single pass and return the set of keys,
+	without building an intermediate TXTRecord or dictionary.
+	'''
+
+	# Normalize string-typed records to their byte representation
+	if isinstance(txt, str): txt = txt.encode('latin-1')
+
+	keys, view, nbytes, idx = set(), memoryview(txt), len(txt), 0
+
+	while idx < nbytes:
+		# Read the length prefix, then pull the entry that follows
+		nent = view[idx]
+		idx += 1
+		entry = bytes(view[idx:idx + nent])
+		idx += nent
+		# The key runs to the first '=', or the whole entry
+		eq = entry.find(b'=')
+		if eq >= 0: entry = entry[:eq]
+		keys.add(entry.decode('latin-1'))
+
+	return keys
+
 
 class BonjourRepeater:
 	'''
@@ -14,7 +47,8 @@ class BonjourRepeater:
 	'''
 
 	def __init__(self, svctype, rpttype, afields, rfields=[],
-			prefix="Repeated", timeout=5, restrict=None):
+			prefix="Repeated", timeout=0.25, restrict=None,
+			resttl=120, maxwait=4):
 		'''
 		Initialize the class to listen for services of type svctype,
 		repeat with a service type rpttype, add TXT record entries in
@@ -22,7 +56,12 @@ class BonjourRepeater:
 		TXT records in the list rfields (each with format "key=value")
 		and modify the service name by adding the specified prefix.
 
-		Browse requests will listen for timeout seconds before failing.
+		The browse loop wakes at least every timeout seconds to check
+		for termination and expired requests; in-flight resolutions
+		and registrations proceed concurrently and are abandoned if
+		they have not completed after maxwait seconds. Successful
+		resolutions are cached and reused for resttl seconds to avoid
+		redundant mDNS round trips when a service reappears.
 
 		The service will not be repeated if any of the specified TXT
 		records in afields already exists. This prevents infinitely
@@ -43,21 +82,60 @@ class BonjourRepeater:
 		self.rpttype = rpttype
 		self.prefix = prefix
 
-		# Split each new or replaced record field into its own dictionary
-		self.afields = dict([[f[0], '='.join(f[1:])]
-			for f in [fv.split('=') for fv in afields]])
-		try: self.rfields = dict([[f[0], '='.join(f[1:])]
-			for f in [fv.split('=') for fv in rfields]])
+		# The prefix (plus separator) prepended to repeated names,
+		# also used to recognize and skip services repeated by us
+		self._prefix_sp = prefix + ' '
+
+		# Split each new or replaced record field into its own
+		# dictionary; partition splits on the first '=' only, so
+		# values containing '=' survive without a rejoin
+		self.afields = {k: v for k, _, v in
+				(fv.partition('=') for fv in afields)}
+		try: self.rfields = {k: v for k, _, v in
+				(fv.partition('=') for fv in rfields)}
 		except TypeError: self.rfields = {}
 
-		# Copy the timeout value
+		# Frozen key sets for fast containment tests in the resolver
+		self._afield_keys = frozenset(self.afields)
+		self._rfield_keys = frozenset(self.rfields)
+
+		# All added and replaced fields merged into one sequence so
+		# accepted records are mutated in a single pass
+		self._mfields = (tuple(self.afields.items())
+				+ tuple(self.rfields.items()))
+
+		# Copy the loop tick and the in-flight request deadline
 		self.timeout = timeout
+		self.maxwait = maxwait
+
+		# Copy the lifetime of cached resolutions
+		self.resttl = resttl
 
-		# A dictionary of repeated Bonjour entries
+		# Repeated Bonjour entries, bucketed by interface index and
+		# keyed within each bucket by (service, type, domain); small
+		# integer dispatch plus a short tuple hashes more cheaply
+		# than one long concatenated string
 		self.repeater = {}
 
-		# A buffer to store results from callback processing
-		self.cbresult = []
+		# A cache of resolved records, bucketed and keyed like the
+		# repeater dictionary, holding (expiry, record) pairs
+		self._rescache = {}
+
+		# In-flight resolutions and registrations awaiting completion
+		# in the browse loop, keyed by descriptor number
+		self._pending = {}
+
+		# The same in-flight requests indexed by (interface, service,
+		# type, domain) so browse events can find and cancel them
+		self._inflight = {}
+
+		# Log messages deferred by callbacks, drained by the browse
+		# loop so stdout flushes never stall the event path
+		self._log = collections.deque()
+
+		# A selector (epoll or kqueue where available) used to await
+		# readiness of Bonjour references without rebuilding fd sets
+		self._sel = _Selector()
 
 		# This variable controls the browse/repeat thread loop
 		self.browse = False
@@ -67,85 +145,181 @@ class BonjourRepeater:
 		else: self.restrict = None
 
 
-	def register(self, sdRef, flags, err, name, rtype, dom):
+	def register(self, res, sdRef, flags, err, name, rtype, dom):
 		'''
-		Invoked after a service registration attempt. Vocalize and note
-		the success or failure of the attempt.
+		Invoked after a service registration attempt. Vocalize the
+		success or failure of the attempt and note it in the result
+		slot res bound to this registration.
 		'''
 
-		srvmsg = 'service %s of type %s on domain %s' % (name, rtype, dom)
+		srvmsg = f'service {name} of type {rtype} on domain {dom}'
 
 		if err != mdns.kDNSServiceErr_NoError:
 			# Note a failure to register
-			print('Failed to register', srvmsg)
-			self.cbresult.append(False)
+			self._log.append(f'Failed to register {srvmsg}')
+			res.append(False)
 			return
 
-		print('Advertising', srvmsg)
-		self.cbresult.append(True)
+		self._log.append(f'Advertising {srvmsg}')
+		res.append(True)
 
 
-	def resolver(self, sdRef, flags, ifidx, err, name, tgt, port, txt):
+	def resolver(self, res, sdRef, flags, ifidx, err, name, tgt, port, txt):
 		'''
 		Invoked after a service resolution attempt. If successful, the
 		target host, port, and TXT record (with added and replaced
-		fields) are stored in the result buffer for repetition.
+		fields) are stored in the result slot res bound to this
+		resolution.
 		'''
 
 		# Do nothing if there was a resolution error
 		# Resolution attempts will continue
 		if err != mdns.kDNSServiceErr_NoError: return
 
-		# Create a TXTRecord type for processing
-		txtdict = mdns.TXTRecord.parse(txt)
-
-		# Grab the existing keys
-		keys = list(dict(txtdict).keys())
-
 		# Don't continue if the host is restricted and the current
 		# target doesn't match the restricted host
 		if self.restrict is not None and self.restrict != tgt:
-			self.cbresult.append(None)
+			res.append(None)
 			return
 
-		# Add new records, failing if a matching record already exists
-		for k, v in self.afields.items():
-			if k in keys:
-				self.cbresult.append(None)
-				return
-			else: txtdict[k] = v
+		# Scan the raw record keys in a single pass, rejecting the
+		# record without a parse if any new record already exists or
+		# any replaced record is missing
+		keys = _txtkeys(txt)
+		if (not self._afield_keys.isdisjoint(keys)
+				or not self._rfield_keys.issubset(keys)):
+			res.append(None)
+			return
 
-		# Replace existing records, failing if a matching record doesn't exist
-		for k, v in self.rfields.items():
-			if k not in keys:
-				self.cbresult.append(None)
-				return
-			else: txtdict[k] = v
+		# Parse the accepted record so it can be modified
+		txtdict = mdns.TXTRecord.parse(txt)
+
+		# Add the new records and replace the existing ones
+		for k, v in self._mfields: txtdict[k] = v
 
 		# Store the host, port and TXT record to be repeated
-		self.cbresult.append([tgt, port, txtdict])
+		res.append([tgt, port, txtdict])
+
+
+	def _monitor(self, stage, sdref, res, rptkey, rptname, ifidx, dom, svc):
+		'''
+		Track the in-flight Bonjour request sdref, at the indicated
+		stage ('resolve' or 'register') with its bound result slot
+		res, in the central selector so the browse loop can finish the
+		request when its callback fires or abandon it after maxwait
+		seconds.
+		'''
+
+		pend = (stage, sdref, res, rptkey, rptname, ifidx, dom, svc,
+				time.monotonic() + self.maxwait)
+		self._sel.register(sdref, selectors.EVENT_READ, pend)
+		# Service references define equality without hashing, so the
+		# pending table is keyed by the descriptor number instead
+		self._pending[sdref.fileno()] = pend
+		self._inflight[(ifidx,) + rptkey] = pend
+
+
+	def _startreg(self, rptkey, rptname, ifidx, dom, svc, rec):
+		'''
+		Begin an asynchronous registration of the repeated service
+		rptname from the resolved record rec, monitored by the browse
+		loop.
+		'''
+
+		reg = []
+		regref = mdns.DNSServiceRegister(0, ifidx,
+				rptname, self.rpttype, dom,
+				rec[0], rec[1], rec[2],
+				lambda *args: self.register(reg, *args))
+
+		self._monitor('register', regref, reg, rptkey, rptname, ifidx, dom, svc)
 
 
-	def wait(self, sdref):
+	def _cancel(self, pend):
 		'''
-		Wait (with timeout) for the provided Bonjour reference to
-		complete, then process the result to invoke the provided
-		callback.
+		Abandon the in-flight request pend outright, closing its
+		reference and discarding any result its callback produced.
+		'''
+
+		sdref, ifidx, rptkey = pend[1], pend[5], pend[3]
+
+		self._sel.unregister(sdref)
+		del self._pending[sdref.fileno()]
+		del self._inflight[(ifidx,) + rptkey]
+
+		sdref.close()
 
-		After the callback has been called in the call to
-		DNSServiceProcessResult, copy and return the result.
+
+	def _drainlog(self):
+		'''
+		Write any log messages deferred by the Bonjour callbacks to
+		standard output in a single call.
 		'''
 
-		rec = None
-		while not self.cbresult:
-			# Wait until the resolution result is ready
-			ready = select.select([sdref], [], [], self.timeout)
-			if sdref not in ready[0]: break
-			# Continue to attempt the query if an error occurred
-			mdns.DNSServiceProcessResult(sdref)
-		else: rec = self.cbresult.pop()
+		if not self._log: return
+
+		msgs = []
+		while self._log: msgs.append(self._log.popleft())
+		msgs.append('')
+
+		sys.stdout.write('\n'.join(msgs))
 
-		return rec
+
+	def _finish(self, pend):
+		'''
+		Complete or abandon the in-flight request pend, removing it
+		from the selector. A finished resolution is cached and
+		advanced to registration; a finished registration is recorded
+		in the repeater dictionary. Requests whose result slots are
+		still empty have expired and are dropped.
+		'''
+
+		stage, sdref, res, rptkey, rptname, ifidx, dom, svc = pend[:8]
+
+		self._sel.unregister(sdref)
+		del self._pending[sdref.fileno()]
+		del self._inflight[(ifidx,) + rptkey]
+
+		# An empty result slot marks an expired request; a slot
+		# holding None marks a definite rejection by the callback
+		rejected = bool(res)
+		rec = res.pop() if res else None
+
+		if stage == 'resolve':
+			# The resolution reference is no longer needed
+			sdref.close()
+
+			if rec is None:
+				# Remember definite rejections (restricted host
+				# or unsuitable TXT record) so rediscoveries of
+				# the same service skip the resolve entirely
+				if rejected:
+					self._rescache.setdefault(ifidx, {})[
+						rptkey] = (time.monotonic()
+							+ self.resttl, None)
+				self._log.append(f'Service {svc} not repeated')
+				return
+
+			# Cache the successful resolution for later rediscovery
+			self._rescache.setdefault(ifidx, {})[rptkey] = (
+					time.monotonic() + self.resttl, rec)
+
+			# Advance to registration of the repeated service; a
+			# failure to start the request affects just this service
+			try: self._startreg(rptkey, rptname, ifidx, dom, svc, rec)
+			except mdns.BonjourError:
+				self._log.append(f'Service {svc} not repeated')
+		else:
+			# Keep a successful registration open for repetition
+			if rec:
+				bucket = self.repeater.setdefault(ifidx, {})
+				# Never orphan a reference already in the slot
+				try: bucket[rptkey].close()
+				except KeyError: pass
+				bucket[rptkey] = sdref
+			else:
+				sdref.close()
+				self._log.append(f'Failed to register service {rptname}')
 
 
 	def browser(self, sdRef, flags, ifidx, err, svc, rtype, dom):
@@ -158,53 +332,65 @@ class BonjourRepeater:
 		# Do nothing if there was a browse error
 		if err != mdns.kDNSServiceErr_NoError: return
 
-		# Generate a unique key to identify the service to be repeated
-		rptkey = ','.join(repr(s) for s in [svc, rtype, dom, ifidx])
+		# Never repeat a service that carries our own prefix; this
+		# cheap check skips a resolve before the TXT-record guard
+		# would reject the service anyway
+		if svc.startswith(self._prefix_sp): return
 
-		# If the key already exists in the repeater dictionary, then
+		# Identify the service by its interface bucket and a key of
+		# the name, type and domain within that bucket
+		bucket = self.repeater.setdefault(ifidx, {})
+		rptkey = (svc, rtype, dom)
+
+		# If the key already exists in the repeater bucket, then
 		# either the identified service has been removed or the service
 		# has changed. Either way, stop repeating the old service.
 		try:
 			# Attempt to deregister the repeated service
-			self.repeater[rptkey].close()
+			bucket[rptkey].close()
 			# Attempt to eliminate the service name from the repeat list
-			del self.repeater[rptkey]
-			print('Stopped repeating', svc)
+			del bucket[rptkey]
+			self._log.append(f'Stopped repeating {svc}')
 		except KeyError: pass
 
-		# Nothing to do if the service is noted as removed
-		if not (flags & mdns.kDNSServiceFlagsAdd): return
+		# When the service disappears, drop any cached resolution
+		# and abandon any repeat attempt still in flight so the
+		# vanished service is not registered after the fact
+		if not (flags & mdns.kDNSServiceFlagsAdd):
+			try: del self._rescache[ifidx][rptkey]
+			except KeyError: pass
+			pend = self._inflight.get((ifidx,) + rptkey)
+			if pend is not None: self._cancel(pend)
+			return
+
+		# A repeat attempt already in flight covers this
+		# announcement; starting another would duplicate the service
+		if (ifidx,) + rptkey in self._inflight: return
 
 		# Add the prefix (and a space) to the existing service name
-		rptname = self.prefix + ' ' + svc
-
-		# Attempt to resolve the advertised service on the interface
-		resref = mdns.DNSServiceResolve(0, ifidx, svc, rtype, dom, self.resolver)
+		rptname = self._prefix_sp + svc
 
+		# Consult the cache before paying for any mDNS round trip: a
+		# fresh record skips straight to registration, while a fresh
+		# negative entry means the service was already rejected
 		try:
-			# Wait for the resolution to finish and return the record data
-			rec = self.wait(resref)
-
-			# If the resolution attempt yielded no useful result,
-			# throw an exception to skip advertisement and ensure
-			# the lookup is closed
-			if rec is None: raise mdns.BonjourError(mdns.kDNSServiceErr_Unknown)
-
-			# Register the new service on the same interface
-			regref = mdns.DNSServiceRegister(0, ifidx,
-					rptname, self.rpttype, dom,
-					rec[0], rec[1], rec[2], self.register)
-
-			try:
-				# Copy the finished registration if successful
-				if self.wait(regref): self.repeater[rptkey] = regref
-				else: raise mdns.BonjourError(mdns.kDNSServiceErr_Unknown)
-			except mdns.BonjourError:
-				# Only close the reference in the event of a failure
-				regref.close()
-				print('Failed to register service', rptname)
-		except mdns.BonjourError: print('Service', svc, 'not repeated')
-		finally: resref.close()
+			expiry, rec = self._rescache[ifidx][rptkey]
+			if time.monotonic() < expiry:
+				if rec is None: return
+				self._startreg(rptkey, rptname,
+						ifidx, dom, svc, rec)
+				return
+			del self._rescache[ifidx][rptkey]
+		except KeyError: pass
+
+		# Start an asynchronous resolution of the advertised service,
+		# binding a private result slot to the callback; the browse
+		# loop finishes the request when the resolution completes
+		res = []
+		resref = mdns.DNSServiceResolve(0, ifidx, svc, rtype, dom,
+				lambda *args: self.resolver(res, *args))
+
+		self._monitor('resolve', resref, res, rptkey, rptname, ifidx, dom, svc)
 
 	def repeatloop(self):
 		'''
@@ -217,8 +403,10 @@ class BonjourRepeater:
 		When the loop is terminated, close the browse request.
 
 		Listening is done for timeout seconds so that the loop can be
-		terminated if desired. After termination, all repeated services
-		are removed.
+		terminated if desired. The same selector wakes for the browse
+		reference and for every in-flight resolution or registration,
+		so a burst of new services is processed concurrently. After
+		termination, all repeated services are removed.
 		'''
 
 		# Attempt a browse of the service type
@@ -227,22 +415,79 @@ class BonjourRepeater:
 
 		self.browse = True
 
+		# Register the browse reference once for the life of the loop
+		self._sel.register(browseref, selectors.EVENT_READ)
+
+		# Hoist hot lookups out of the browse loop
+		poll, procresult = self._sel.select, mdns.DNSServiceProcessResult
+
 		try:
 			while self.browse:
-				ready = select.select([browseref], [], [], self.timeout)
-				if browseref in ready[0]:
-					mdns.DNSServiceProcessResult(browseref)
+				# Sleep for a full tick unless an in-flight
+				# request would reach its deadline sooner
+				wtime = self.timeout
+				if self._pending:
+					first = min(p[8] for p in
+							self._pending.values())
+					wtime = min(wtime, max(0,
+						first - time.monotonic()))
+
+				for key, _ in poll(timeout=wtime):
+					# The pend tuple rides along as the
+					# selector data for monitored requests
+					pend = key.data
+					# Skip events whose requests were
+					# cancelled earlier in this batch; the
+					# descriptor may even belong to a
+					# newer request by now
+					if (pend is not None and
+							self._pending.get(key.fd)
+							is not pend):
+						continue
+					try: procresult(key.fileobj)
+					except mdns.BonjourError:
+						# A failure on one monitored
+						# request abandons only that
+						# request; a failure of the
+						# browse reference is fatal
+						if pend is None: raise
+						self._finish(pend)
+						continue
+					# Finish the request if its callback fired
+					if pend is not None and pend[2]:
+						self._finish(pend)
+
+				# Abandon requests that outlived their deadlines
+				if self._pending:
+					now = time.monotonic()
+					expired = [p for p in
+							self._pending.values()
+							if p[8] <= now]
+					for pend in expired: self._finish(pend)
+
+				# Emit any messages the callbacks deferred
+				self._drainlog()
 		finally:
+			# Abandon all requests still in flight; finishing a
+			# completed resolution may enqueue a registration, so
+			# drain until the pending table is empty
+			while self._pending:
+				self._finish(next(iter(self._pending.values())))
+			# Remove the browse reference from the selector
+			self._sel.unregister(browseref)
 			# Attempt to close all open repeater references
-			for v in list(self.repeater.values()): v.close()
+			for bucket in list(self.repeater.values()):
+				for v in list(bucket.values()): v.close()
 			# Reset the repeater dictionary
 			self.repeater = {}
 			# Close the open browse request
 			browseref.close()
+			# Emit any messages deferred during shutdown
+			self._drainlog()
 
 
 def usage (progname):
-	print('Usage: %s [-h] <-s type> <-r type> <-f key=value> [-p prefix] [-t timeout] [-F key=value] [-n]' % progname, file=sys.stderr)
+	print('Usage: %s [-h] <-s type> <-r type> <-f key=value> [-p prefix] [-t timeout] [-w maxwait] [-T resttl] [-F key=value] [-n]' % progname, file=sys.stderr)
 	print('  -h: display this message', file=sys.stderr)
 	print('  -s type: Bonjour type for which to browse', file=sys.stderr)
 	print('  -r type: Bonjour type to use when repeating services', file=sys.stderr)
@@ -251,16 +496,18 @@ def usage (progname):
 	print('  -F key=value: replace the key=value field in the TXT record', file=sys.stderr)
 	print('     Multiple fields may be added with additional -F flags', file=sys.stderr)
 	print('  -p prefix: string to prepend to service name (default: "Repeated")', file=sys.stderr)
-	print('  -t timeout: timeout in seconds for Bonjour requests (default: 5)', file=sys.stderr)
+	print('  -t timeout: wake interval in seconds for the browse loop (default: 0.25)', file=sys.stderr)
+	print('  -w maxwait: deadline in seconds for in-flight Bonjour requests (default: 4)', file=sys.stderr)
+	print('  -T resttl: lifetime in seconds of cached resolutions (default: 120)', file=sys.stderr)
 	print('  -n: Repeat all services found on network (default: only repeat local services)', file=sys.stderr)
 
 
 if __name__ == '__main__':
 	# Parse the option list
-	optlist, args = getopt.getopt(sys.argv[1:], 's:r:f:F:p:t:hn')
+	optlist, args = getopt.getopt(sys.argv[1:], 's:r:f:F:p:t:w:T:hn')
 
 	# Initialize the values for the repeater class
-	svcname, rptname, prefix, timeout = [None]*4
+	svcname, rptname, prefix, timeout, maxwait, resttl = [None]*6
 	# Initialize lists of fields to be appended or replaced in TXT record
 	afields, rfields = [], []
 	# By default, only repeat printers shared by the current machine
@@ -275,7 +522,9 @@ if __name__ == '__main__':
 		elif opt[0] == '-f': afields.append(opt[1])
 		elif opt[0] == '-F': rfields.append(opt[1])
 		elif opt[0] == '-p': prefix = opt[1]
-		elif opt[0] == '-t': timeout = int(opt[1])
+		elif opt[0] == '-t': timeout = float(opt[1])
+		elif opt[0] == '-w': maxwait = float(opt[1])
+		elif opt[0] == '-T': resttl = float(opt[1])
 		elif opt[0] == '-n': noisy = True
 
 	if svcname is None or rptname is None or len(afields) == 0:
@@ -292,8 +541,10 @@ if __name__ == '__main__':
 
 	# Add the desired prefix
 	if prefix is not None: kwargs['prefix'] = prefix
-	# Set the desired timeout for Bonjour requests
+	# Set the desired loop tick, request deadline and cache lifetime
 	if timeout is not None: kwargs['timeout'] = timeout
+	if maxwait is not None: kwargs['maxwait'] = maxwait
+	if resttl is not None: kwargs['resttl'] = resttl
 
 	# Build the desired repeater
 	rpt = BonjourRepeater(svcname, rptname, afields, rfields, **kwargs)
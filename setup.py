@@ -23,7 +23,7 @@ if __name__ == '__main__':
 			author='Andrew J. Hesford',
 			author_email='ajh@sideband.org',
 			platforms=['any'], license='BSD',
-			scripts=['bonjour-repeater.py',],
+			scripts=['bonjour-repeater.py', 'airprint.py',],
 			install_requires=[
 				'pyobjc-framework-SystemConfiguration',
 				'pybonjour',